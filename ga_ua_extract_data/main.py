@@ -1,12 +1,27 @@
 from datetime import datetime
+import hashlib
+import io
 import os
-import time
+import tempfile
 
 import functions_framework
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 from ga_ua_api import ga_api_request_data
 
+# Files larger than this are uploaded as concurrent chunks from a temporary file. On Cloud Functions /tmp is
+# memory-backed, so spooling the in-memory file there briefly doubles memory use for these large files.
+UPLOAD_CONCURRENT_THRESHOLD = 32 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_WORKERS = 8
+
+# Storage clients reused across invocations on a warm instance, keyed by project id and the contents of the credentials file
+_CLIENT_CACHE = {}
+
 @functions_framework.http
 def get_ga_data(request):
     """HTTP Cloud Function
@@ -25,8 +40,21 @@ def get_ga_data(request):
         return_data['message'] = "No request payload"
         return return_data
 
+    return run_extraction(request_json)
+
+def run_extraction(payload, download_auth = True):
+    """Extract Google Analytics data for a single extraction template and date range and upload it to Google Cloud Storage. Does the work of `get_ga_data` without the HTTP wrapper so it can also be called in-process.
+
+    Args:
+        payload (dictionary): The extraction request payload
+        download_auth (bool, optional): Download the payload's auth blob to /tmp/auth.json and set GOOGLE_APPLICATION_CREDENTIALS. In-process callers that have already done this pass False. Defaults to True.
+
+    Returns:
+        dictionary: A dictionary with the status and message of the extraction and the request data
+    """
+
     request_data = dict()
-    request_data.update(request_json)
+    request_data.update(payload)
 
     # Try setting all required variables from the request payload. Fail if any are not set.
     try:
@@ -59,27 +87,24 @@ def get_ga_data(request):
     extract_account_id =  request_data.get('account_id')
     extract_account_name = request_data.get('account_name')
     extract_template_type = request_data.get('template_type', 'Non Template')
+    target_file_format = request_data.get('format', 'parquet')
 
-    print('Download auth file and set GOOGLE_APPLICATION_CREDENTIALS environment variable')
-    download_blob(config_file_bucket, config_file_auth_blob, '/tmp/auth.json')
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/tmp/auth.json'
-
-    retries = 0
-    retry = 3
-    while retries < retry:
-        if os.path.isfile('/tmp/auth.json'):
-            print(f"Starting data extraction for {extract_template_name} for dates of {extract_start_date} to {extract_end_date}")
-            ga_df = ga_api_request_data(None, extract_view_id, extract_start_date, extract_end_date, extract_metrics_list, extract_dimensions_list, anti_sampling = True)
-            break
-        time.sleep(3)
-        retries += 1
-    else:
+    if target_file_format not in ('parquet', 'csv'):
+        print(f"Unsupported target file format: {target_file_format}")
         return_data = dict()
         return_data['status'] = "Failed"
-        return_data['message'] = f"Unable to load auth file after {retries} retries"
+        return_data['message'] = f"Unsupported target file format: {target_file_format}. Accepts 'parquet' or 'csv'"
         return_data['request_data'] = request_data
         return return_data
 
+    if download_auth:
+        print('Download auth file and set GOOGLE_APPLICATION_CREDENTIALS environment variable')
+        download_blob(config_file_bucket, config_file_auth_blob, '/tmp/auth.json')
+        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/tmp/auth.json'
+
+    print(f"Starting data extraction for {extract_template_name} for dates of {extract_start_date} to {extract_end_date}")
+    ga_df = ga_api_request_data(None, extract_view_id, extract_start_date, extract_end_date, extract_metrics_list, extract_dimensions_list, anti_sampling = True)
+
     print('Add GA meta data to GA dataframe')
     ga_df['view_id'] = extract_view_id
     ga_df['view_name'] = extract_view_name
@@ -92,11 +117,22 @@ def get_ga_data(request):
     if 'date' in ga_df.columns:
         ga_df['date'] = pd.to_datetime(ga_df['date'], format='%Y%m%d')
 
-    print('Create csv file from GA dataframe')
-    csv_file_name = f'{target_file_blob}{extract_view_id}/{extract_template_type}/{extract_template_name}/{extract_template_name}_{datetime.strptime(extract_start_date, "%Y-%m-%d").strftime("%Y%m%d")}.csv'
-    csv_file_blob = ga_df.to_csv(index=False)
+    print(f'Create {target_file_format} file from GA dataframe')
+    target_file_name = f'{target_file_blob}{extract_view_id}/{extract_template_type}/{extract_template_name}/{extract_template_name}_{datetime.strptime(extract_start_date, "%Y-%m-%d").strftime("%Y%m%d")}.{target_file_format}'
+    ga_table = pa.Table.from_pandas(ga_df, preserve_index=False)
+    # Write the date field as a plain date (YYYY-MM-DD) rather than a full timestamp
+    if 'date' in ga_table.column_names:
+        ga_table = ga_table.set_column(ga_table.column_names.index('date'), 'date', ga_table['date'].cast(pa.date32()))
+    target_file_buffer = io.BytesIO()
+    if target_file_format == 'parquet':
+        pq.write_table(ga_table, target_file_buffer, compression='zstd')
+        content_type = 'application/octet-stream'
+    else:
+        pacsv.write_csv(ga_table, target_file_buffer, write_options=pacsv.WriteOptions(include_header=True))
+        content_type = 'text/csv'
+    target_file_buffer.seek(0)
 
-    upload_blob(target_file_bucket, csv_file_blob, csv_file_name, target_file_project)
+    upload_blob(target_file_bucket, target_file_buffer, target_file_name, target_file_project, content_type)
 
     return_data = dict()
     return_data['status'] = "Success"
@@ -117,10 +153,7 @@ def download_blob(bucket_name, source_blob_name, destination_file_name, project_
         Exception: If the source storage bucket does not exist, then raise this exception.
     """
 
-    if project_id is None:
-        storage_client = storage.Client(project=os.environ.get('GCP_PROJECT'))
-    else:
-        storage_client = storage.Client(project=project_id)
+    storage_client = _client(project_id)
 
     try:
         bucket = storage_client.get_bucket(bucket_name)
@@ -133,22 +166,20 @@ def download_blob(bucket_name, source_blob_name, destination_file_name, project_
 
     print(f"Blob {source_blob_name} downloaded to {destination_file_name}")
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name, project_id = None):
-    """Upload a string to a Google Cloud Storage bucket
+def upload_blob(bucket_name, source_file, destination_blob_name, project_id = None, content_type = 'text/csv'):
+    """Upload an in-memory binary file to a Google Cloud Storage bucket
 
     Args:
         bucket_name (string): Name of the destination Google Cloud Storage bucket
-        source_file_name (string): The source string to upload
+        source_file (io.BytesIO): The source binary file object to upload, positioned at the start of the data
         destination_blob_name (string): Name of the destination Google Cloud Storage bucket path location
         project_id (string, optional): Google Cloud Platform project id where the destination bucket exists. Defaults to None and looks for the project id in an environment variable 'GCP_PROJECT'. Defaults to None.
+        content_type (string, optional): Content type to set on the uploaded object. Defaults to 'text/csv'.
 
     Raises:
         Exception: If the destination storage bucket does not exist, then raise this exception.
     """
-    if project_id is None:
-        storage_client = storage.Client(project=os.environ.get('GCP_PROJECT'))
-    else:
-        storage_client = storage.Client(project=project_id)
+    storage_client = _client(project_id)
 
     try:
         bucket = storage_client.get_bucket(bucket_name)
@@ -157,6 +188,36 @@ def upload_blob(bucket_name, source_file_name, destination_blob_name, project_id
 
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_string(source_file_name, content_type='text/csv')
+    source_file_size = source_file.getbuffer().nbytes
+    if source_file_size > UPLOAD_CONCURRENT_THRESHOLD:
+        # Large files are spooled to local disk and uploaded as chunks over multiple connections
+        with tempfile.NamedTemporaryFile(dir='/tmp') as temp_file:
+            temp_file.write(source_file.getbuffer())
+            temp_file.flush()
+            transfer_manager.upload_chunks_concurrently(temp_file.name, blob, content_type=content_type, chunk_size=UPLOAD_CHUNK_SIZE, max_workers=UPLOAD_MAX_WORKERS, worker_type=transfer_manager.THREAD)
+    else:
+        blob.upload_from_file(source_file, content_type=content_type, size=source_file_size)
 
     print(f"File uploaded to gs://{bucket_name}/{destination_blob_name}")
+
+def _client(project_id = None):
+    """Return a cached Google Cloud Storage client, creating one on first use
+
+    Args:
+        project_id (string, optional): Google Cloud Platform project id for the client. Defaults to None and looks for the project id in an environment variable 'GCP_PROJECT'.
+
+    Returns:
+        google.cloud.storage.Client: A storage client for the project and current GOOGLE_APPLICATION_CREDENTIALS
+    """
+    # Each request can download a different service account to the same credentials file, so key on its contents rather than its path
+    credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    credentials_digest = None
+    if credentials_file is not None and os.path.isfile(credentials_file):
+        with open(credentials_file, 'rb') as credentials:
+            credentials_digest = hashlib.sha256(credentials.read()).hexdigest()
+    key = (project_id or os.environ.get('GCP_PROJECT'), credentials_file, credentials_digest)
+    storage_client = _CLIENT_CACHE.get(key)
+    if storage_client is None:
+        storage_client = storage.Client(project=key[0])
+        _CLIENT_CACHE[key] = storage_client
+    return storage_client
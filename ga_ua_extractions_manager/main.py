@@ -1,16 +1,153 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+import hashlib
+import math
 import os
-import json
 import random
-import calendar
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import time
+from email.utils import parsedate_to_datetime
 
 import functions_framework
 import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import pandas as pd
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 import aiohttp
-from aiolimiter import AsyncLimiter
+import orjson
+
+# Set GA_UA_EXTRACT_IN_PROCESS=true to run extractions in-process instead of over HTTP. This needs the shared deployment described in README.md.
+EXTRACT_IN_PROCESS = os.environ.get('GA_UA_EXTRACT_IN_PROCESS', '').lower() == 'true'
+if EXTRACT_IN_PROCESS:
+    try:
+        from ga_ua_extract_data.main import run_extraction
+    except ImportError as exc:
+        raise ImportError("GA_UA_EXTRACT_IN_PROCESS is set but ga_ua_extract_data could not be imported. Deploy the manager together with the extract function as described in README.md") from exc
+
+# Highest number of concurrent requests or in-process extractions the AIMD limit allows
+AIMD_MAX_LIMIT = 64
+
+if EXTRACT_IN_PROCESS:
+    # In-process extractions run on their own thread pool, sized so the AIMD limit rather than the pool caps concurrency
+    _EXTRACTION_EXECUTOR = ThreadPoolExecutor(max_workers=AIMD_MAX_LIMIT, thread_name_prefix='ga_ua_extract')
+    # In-process extractions read the shared /tmp/auth.json and GOOGLE_APPLICATION_CREDENTIALS, so only one invocation may run at a time
+    _IN_PROCESS_AUTH_LOCK = threading.Lock()
+
+# Storage clients reused across invocations on a warm instance, keyed by project id and the contents of the credentials file
+_CLIENT_CACHE = {}
+
+# Each worker thread keeps its own event loop and aiohttp client session so that keep-alive connections to the next function are reused across invocations
+_THREAD_LOCAL = threading.local()
+
+# HTTP status codes from the next function that mean it is overloaded and concurrency should back off.
+# 500 is left out because the extract function returns it for its own errors, such as Google Analytics API failures.
+THROTTLE_STATUS_CODES = (429, 502, 503, 504)
+
+# Smoothed extraction latency, in seconds, above which the next function is treated as saturated and concurrency stops growing
+AIMD_TARGET_LATENCY = 120
+
+# Exponential backoff settings, in seconds, for retrying requests to the next function
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 30
+
+class AIMDConcurrencyLimit:
+    """Limits the number of in-flight requests to the next function using additive increase, multiplicative decrease (AIMD).
+
+    The limit grows by `increase` after each successful request whose smoothed latency is within the target, and is multiplied by `decrease` once per congestion event. Failures from requests that started before the last decrease belong to the same event and are ignored.
+
+    Args:
+        min_limit (int, optional): Lowest number of concurrent requests allowed. Defaults to 1.
+        max_limit (int, optional): Highest number of concurrent requests allowed. Defaults to 64.
+        initial_limit (int, optional): Number of concurrent requests allowed at the start. Defaults to 8.
+        increase (float, optional): Amount added to the limit after a successful request. Defaults to 0.5.
+        decrease (float, optional): Factor the limit is multiplied by after a throttled or failed request. Defaults to 0.5.
+        target_latency (float, optional): Smoothed response latency in seconds above which the limit stops growing. Defaults to None for no latency target.
+    """
+
+    def __init__(self, min_limit = 1, max_limit = 64, initial_limit = 8, increase = 0.5, decrease = 0.5, target_latency = None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(initial_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.latency_ewma = None
+        self.last_decrease = float('-inf')
+        self.in_flight = 0
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def record_success(self, latency):
+        """Additively increase the concurrency limit after a successful request
+
+        Args:
+            latency (float): Response latency of the request in seconds
+        """
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = 0.2 * latency + 0.8 * self.latency_ewma
+        if self.target_latency is None or self.latency_ewma <= self.target_latency:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+
+    def record_failure(self, request_start):
+        """Multiplicatively decrease the concurrency limit after a throttled or failed request, unless the limit was already decreased after the request started
+
+        Args:
+            request_start (float): time.monotonic() value from when the failed request was sent
+        """
+        if request_start < self.last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self.last_decrease = time.monotonic()
+
+class InstanceRateLimit:
+    """Limits the rate of requests to the next function across every worker thread and event loop in this instance.
+
+    Uses a generic cell rate algorithm: each request reserves the next slot under a thread lock and then sleeps on its own event loop until that slot, allowing bursts of up to `max_rate` requests.
+
+    Args:
+        max_rate (int): Number of requests allowed per time period
+        time_period (float, optional): Length of the time period in seconds. Defaults to 60.
+    """
+
+    def __init__(self, max_rate, time_period = 60):
+        self._interval = time_period / max_rate
+        self._burst_tolerance = time_period - self._interval
+        self._theoretical_arrival = 0.0
+        self._lock = threading.Lock()
+
+    async def __aenter__(self):
+        with self._lock:
+            now = time.monotonic()
+            theoretical_arrival = max(self._theoretical_arrival, now)
+            self._theoretical_arrival = theoretical_arrival + self._interval
+            wait_time = theoretical_arrival - self._burst_tolerance - now
+        if wait_time > 0:
+            await asyncio.sleep(wait_time)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return None
+
+# Rate limit http requests to the next function. The budget is per instance: it is shared by every worker thread and invocation on this instance.
+_RATE_LIMITER = InstanceRateLimit(60)
 
 @functions_framework.http
 def prep_request_batches(request):
@@ -23,6 +160,22 @@ def prep_request_batches(request):
         flask.make_response: The response text, or any set of values that can be turned into a Response object using `make_response`
     """
 
+    if EXTRACT_IN_PROCESS:
+        # Keep other invocations from rewriting the auth file until this invocation's extractions have finished
+        with _IN_PROCESS_AUTH_LOCK:
+            return _prep_request_batches(request)
+    return _prep_request_batches(request)
+
+def _prep_request_batches(request):
+    """Download the config, build a payload for each template and date range batch, and send the payloads to the next function
+
+    Args:
+        request (flask.Request): The request object.
+
+    Returns:
+        dictionary: A dictionary of the results from the attempted requests, or of why the request failed
+    """
+
     request_json = request.get_json(silent=True)
     if request_json is None:
         return "No request payload"
@@ -57,14 +210,13 @@ def prep_request_batches(request):
     extract_standard_extraction_templates_dict = request_data.get('standard_extraction_templates')
     extract_custom_extraction_templates_dict = request_data.get('custom_extraction_templates')
 
-    print('Download auth file and set GOOGLE_APPLICATION_CREDENTIALS environment variable')
-    download_blob(config_file_bucket, config_file_auth_blob, '/tmp/auth.json')
+    print('Download auth and config files and set GOOGLE_APPLICATION_CREDENTIALS environment variable')
+    download_blobs(config_file_bucket, [(config_file_auth_blob, '/tmp/auth.json'), (config_file_blob, '/tmp/config.yaml')])
     os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = '/tmp/auth.json'
 
-    print("Download and open config file")
-    download_blob(config_file_bucket, config_file_blob, '/tmp/config.yaml')
+    print("Open config file")
     with open("/tmp/config.yaml", encoding="UTF-8") as config_file:
-        config = yaml.safe_load(config_file)
+        config = yaml.load(config_file, Loader=SafeLoader)
 
     print('Determining which standard templates to include...')
     standard_extraction_template_list = []
@@ -72,10 +224,11 @@ def prep_request_batches(request):
     if extract_standard_extraction_templates_dict is not None and extract_standard_extraction_templates_dict.get('load_all') is True:
         standard_extraction_template_list = config['data']['standard_extraction_templates']
     else:
+        # Otherwise load the standard templates named in the include list
+        standard_include_set = set((extract_standard_extraction_templates_dict or {}).get('include') or [])
         for template in config['data']['standard_extraction_templates']:
-            if extract_standard_extraction_templates_dict is not None and extract_standard_extraction_templates_dict.get('include') is not None:
-                if template['name'] in extract_standard_extraction_templates_dict.get('include'):
-                    standard_extraction_template_list.append(template)
+            if template['name'] in standard_include_set:
+                standard_extraction_template_list.append(template)
     if standard_extraction_template_list != []:
         print(f'Standard templates to load: {str([sub["name"] for sub in standard_extraction_template_list])}')
     else:
@@ -87,10 +240,11 @@ def prep_request_batches(request):
     if extract_custom_extraction_templates_dict is not None and extract_custom_extraction_templates_dict.get('load_all') is True:
         custom_extraction_template_list = config['data']['custom_extraction_templates']
     else:
+        # Otherwise load the custom templates named in the include list
+        custom_include_set = set((extract_custom_extraction_templates_dict or {}).get('include') or [])
         for template in config['data']['custom_extraction_templates']:
-            if extract_custom_extraction_templates_dict is not None and extract_custom_extraction_templates_dict.get('include') is not None:
-                if template['name'] in extract_custom_extraction_templates_dict.get('include'):
-                    custom_extraction_template_list.append(template)
+            if template['name'] in custom_include_set:
+                custom_extraction_template_list.append(template)
     if custom_extraction_template_list != []:
         print(f'Custom templates to load: {str([sub["name"] for sub in custom_extraction_template_list])}')
     else:
@@ -136,29 +290,15 @@ def prep_request_batches(request):
         return_data['request_data'] = request_data
         return return_data
 
-    # For each template, based on the start date, end date, and batch frequency, split each template into multiple date range requests
-    for template in combined_template_list:
-        print(f'Determine date batches for {template["name"]}')
-        if template.get('batch_freq') is None:
-            batch_freq = None
-        else:
-            batch_freq = template['batch_freq']
-        batch_date_list = ga_api_split_request_date_batch_freq(extract_start_date, extract_end_date, batch_freq)
-        print(f'{len(batch_date_list)} date batches needed for {template["name"]}')
-        template['date_range_batches'] = batch_date_list
-
+    # For each template, based on the start date, end date, and batch frequency, split each template into one payload per date range
     payload_list = []
     for template in combined_template_list:
-        for date_range in template['date_range_batches']:
-            payload = dict()
-            payload.update(template)
-            payload.pop('date_range_batches')
-            payload['start_date'] = date_range['start_date']
-            payload['end_date'] = date_range['end_date']
-            payload_list.append(payload)
+        batch_date_list = ga_api_split_request_date_batch_freq(extract_start_date, extract_end_date, template.get('batch_freq'))
+        print(f'{len(batch_date_list)} date batches needed for {template["name"]}')
+        payload_list.extend({**template, 'start_date': batch_start_date, 'end_date': batch_end_date} for batch_start_date, batch_end_date in batch_date_list)
 
     print(f"Sending a total of [{len(payload_list)}] payloads to the next function")
-    results = asyncio.run(async_requests(payload_list))
+    results = _run(async_requests(payload_list))
 
     # results['status'] = "Success!"
     # print(f"Data load attempts: {results['data_load_attempts']}")
@@ -177,29 +317,27 @@ async def async_requests(payload_list):
     """
     successful_data_loads = []
     failed_data_loads = []
-    # Rate limit http requests to the next function
-    rate_limit = AsyncLimiter(60)
-    # Limit the number of concurrent requests to the next function
-    connector = aiohttp.TCPConnector(limit=8)
-    # Set a timeout of zero for the client session for the http requests
-    timeout = aiohttp.ClientTimeout(total=None, connect=300)
-    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
-        try:
-            task_results = []
-            async with asyncio.TaskGroup() as tg:
-                for payload in payload_list:
-                    task = tg.create_task(aiohttp_request_to_function(session, rate_limit, payload))
-                    task.add_done_callback(task_results.append)
-            for task_result in task_results:
-                result = task_result.result()
-                try:
-                    result_json = json.loads(result)
-                    if result_json['status'] == "Success":
-                        successful_data_loads.append(result)
-                except:
+    # Adapt the number of concurrent requests to the next function based on its responses
+    concurrency_limit = AIMDConcurrencyLimit(max_limit=AIMD_MAX_LIMIT, target_latency=AIMD_TARGET_LATENCY)
+    session = await _get_session()
+    try:
+        async with asyncio.TaskGroup() as tg:
+            if EXTRACT_IN_PROCESS:
+                tasks = [tg.create_task(in_process_request_to_function(concurrency_limit, payload)) for payload in payload_list]
+            else:
+                tasks = [tg.create_task(aiohttp_request_to_function(session, concurrency_limit, payload)) for payload in payload_list]
+        for task in tasks:
+            result = task.result()
+            try:
+                result_json = result if isinstance(result, dict) else orjson.loads(result)
+                if result_json['status'] == "Success":
+                    successful_data_loads.append(result)
+                else:
                     failed_data_loads.append(result)
-        except ExceptionGroup as excg:
-            print(excg.exceptions)
+            except:
+                failed_data_loads.append(result)
+    except ExceptionGroup as excg:
+        print(excg.exceptions)
 
     return_dict = dict()
     return_dict['data_load_attempts'] = len(payload_list)
@@ -207,48 +345,154 @@ async def async_requests(payload_list):
     return_dict['data_load_failures'] = len(failed_data_loads)
     return return_dict
 
-async def aiohttp_request_to_function(session, rate_limit, payload):
+def _run(coro):
+    """Run a coroutine to completion on the current thread's persistent event loop
+
+    Args:
+        coro (coroutine): The coroutine to run
+
+    Returns:
+        any: The result of the coroutine
+    """
+    loop = getattr(_THREAD_LOCAL, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _THREAD_LOCAL.loop = loop
+    return loop.run_until_complete(coro)
+
+async def _get_session():
+    """Return the current thread's aiohttp client session, creating one if there is none or it has been closed
+
+    Returns:
+        aiohttp.ClientSession: An open aiohttp client session for making requests to the next function
+    """
+    session = getattr(_THREAD_LOCAL, 'session', None)
+    if session is None or session.closed:
+        # Cap the number of open connections to the next function and keep idle connections open between invocations
+        connector = aiohttp.TCPConnector(limit=64, limit_per_host=64, keepalive_timeout=300)
+        # Set a timeout of zero for the client session for the http requests
+        timeout = aiohttp.ClientTimeout(total=None, connect=300)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _THREAD_LOCAL.session = session
+    return session
+
+async def aiohttp_request_to_function(session, concurrency_limit, payload):
     """Sends a http post request to the next function.
 
     Args:
         session (aiohttp.ClientSession): An active aiohttp client session for making requests
-        rate_limit (aiolimiter.AsyncLimiter): An aiolimiter object setting the rate limit for the number of http requests
+        concurrency_limit (AIMDConcurrencyLimit): An AIMD limit on the number of concurrent http requests, adjusted from each response
         payload (dictionary): The dictionary payload to send in the http request
 
     Returns:
         dictionary: On success, a dictionary of the response text. On failure, a dictionary of why the request failed.
     """
-    async with rate_limit:
+    async with _RATE_LIMITER:
         response_status = False
+        response_status_code = None
         retries = 0
-        retry = 3
+        retry = 5
         while response_status is False and retries < retry:
             try:
-                response = await session.post("https://ga-ua-extract-data-6f4hxnffwq-uc.a.run.app", json=payload)
-                print(f"Sent a payload to the next function and received a response: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
-                response_status = response.ok
-                if response_status:
-                    response_text = await response.text()
-                    print(f"Data successfully loaded for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
-                    return response_text
-                wait_time = (2 ** retries) + random.random()
-                print(f"Repsonse status code is {response.status}. Waiting {wait_time} seconds before retrying request for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
-                await asyncio.sleep(wait_time)
+                async with concurrency_limit:
+                    request_start = time.monotonic()
+                    async with session.post("https://ga-ua-extract-data-6f4hxnffwq-uc.a.run.app", data=orjson.dumps(payload, option=orjson.OPT_NON_STR_KEYS), headers={'Content-Type': 'application/json'}) as response:
+                        print(f"Sent a payload to the next function and received a response: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                        response_status = response.ok
+                        response_status_code = response.status
+                        retry_after = response.headers.get('Retry-After')
+                        if response_status:
+                            response_text = await response.text()
+                            concurrency_limit.record_success(time.monotonic() - request_start)
+                            print(f"Data successfully loaded for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                            return response_text
+                        if response_status_code in THROTTLE_STATUS_CODES:
+                            concurrency_limit.record_failure(request_start)
                 retries += 1
+                # No point waiting after the last attempt
+                if retries == retry:
+                    print(f"Repsonse status code is {response_status_code}. No retries left for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                    break
+                wait_time = retry_wait_time(retries - 1, retry_after)
+                print(f"Repsonse status code is {response_status_code}. Waiting {wait_time:.2f} seconds before retrying request for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                await asyncio.sleep(wait_time)
             except aiohttp.ClientConnectionError as exc:
-                print(f"Exception: {exc}. Waiting 1 second before retrying request for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
-                await asyncio.sleep(1)
+                # A server disconnect is usually a stale keep-alive connection rather than the next function being overloaded
+                if not isinstance(exc, aiohttp.ServerDisconnectedError):
+                    concurrency_limit.record_failure(request_start)
                 retries += 1
+                if retries == retry:
+                    print(f"Exception: {exc}. No retries left for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                    break
+                wait_time = retry_wait_time(retries - 1)
+                print(f"Exception: {exc}. Waiting {wait_time:.2f} seconds before retrying request for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+                await asyncio.sleep(wait_time)
         print(f"Data failed to load for : {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
         response_text = dict()
         response_text['status'] = "Failed"
         response_text['message'] = f"Unable to load data after {retries} retries"
         response_text['request_data'] = payload
-        response_text['response_status'] = response.status
+        response_text['response_status'] = response_status_code
         return response_text
 
+async def in_process_request_to_function(concurrency_limit, payload):
+    """Runs the extract function's extraction in-process on a worker thread instead of sending a http request. The extraction uses the auth file this invocation has already downloaded.
+
+    Args:
+        concurrency_limit (AIMDConcurrencyLimit): An AIMD limit on the number of concurrent extractions
+        payload (dictionary): The dictionary payload to pass to the extraction
+
+    Returns:
+        dictionary: The result dictionary from the extraction. On an exception, a dictionary of why the extraction failed.
+    """
+    async with _RATE_LIMITER:
+        async with concurrency_limit:
+            try:
+                extraction_start = time.monotonic()
+                result = await asyncio.get_running_loop().run_in_executor(_EXTRACTION_EXECUTOR, functools.partial(run_extraction, payload, download_auth=False))
+                concurrency_limit.record_success(time.monotonic() - extraction_start)
+            except Exception as exc:
+                concurrency_limit.record_failure(extraction_start)
+                print(f"Data failed to load for : {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}. Exception: {exc}")
+                result = dict()
+                result['status'] = "Failed"
+                result['message'] = f"Extraction raised an exception: {exc}"
+                result['request_data'] = payload
+                return result
+    print(f"Extraction finished with status {result['status']} for: {payload['name']} for dates of {payload['start_date']} to {payload['end_date']}")
+    return result
+
+def retry_wait_time(retries, retry_after = None):
+    """Determine how long to wait before retrying a request to the next function. Uses the Retry-After response header when present, otherwise a capped exponential backoff with jitter.
+
+    Args:
+        retries (int): The number of retries already attempted
+        retry_after (string, optional): Value of the Retry-After response header, either a number of seconds or an HTTP date. Capped at RETRY_BACKOFF_CAP seconds. Defaults to None.
+
+    Returns:
+        float: The number of seconds to wait before retrying
+    """
+    if retry_after is not None:
+        retry_after_seconds = None
+        try:
+            retry_after_seconds = float(retry_after)
+        except ValueError:
+            try:
+                retry_after_seconds = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+        # Ignore non-finite values and never wait longer than the backoff cap, whatever the header asks for
+        if retry_after_seconds is not None and math.isfinite(retry_after_seconds):
+            return min(RETRY_BACKOFF_CAP, max(0.0, retry_after_seconds))
+    return min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** retries + random.random() * RETRY_BACKOFF_BASE)
+
+# Pandas period frequencies for each batch frequency. Weeks run Sunday to Saturday.
+BATCH_FREQ_PERIODS = {'daily': 'D', 'weekly': 'W-SAT', 'monthly': 'M'}
+
 def ga_api_split_request_date_batch_freq(start_date, end_date, batch_freq = None):
-    """Takes a start date, end date and batch frequency and returns a list of dictionaries chunnked by the batch frequency. If no batch frequency is set then returns a list of a single dictionary with the full date range.
+    """Takes a start date, end date and batch frequency and returns a list of (start date, end date) tuples chunnked by the batch frequency. If no batch frequency is set then returns a list of a single tuple with the full date range.
+
+    Weekly and monthly batches are expanded to whole weeks (Sunday to Saturday) and whole months that cover the start and end dates.
 
     Args:
         start_date (string): Start date in the format of YYYY-MM-DD
@@ -256,90 +500,60 @@ def ga_api_split_request_date_batch_freq(start_date, end_date, batch_freq = None
         batch_freq (string, optional): Accepts 'daily', 'weekly', or 'monthly values and chunks the date range by this. Defaults to None.
 
     Returns:
-        _type_: _description_
+        list: A list of (start date, end date) tuples in the format of YYYY-MM-DD
     """
-    start_date_dt = datetime.strptime(start_date, "%Y-%m-%d")
-    end_date_dt = datetime.strptime(end_date, "%Y-%m-%d")
-    batch_date_list = []
     if batch_freq is None:
-        batch_dict = {}
-        batch_dict['start_date'] = start_date_dt.strftime("%Y-%m-%d")
-        batch_dict['end_date'] = end_date_dt.strftime("%Y-%m-%d")
-        batch_date_list.append(batch_dict)
-    elif batch_freq == "daily":
-        date_range_list = pd.date_range(start_date, end_date, freq="D").tolist()
-        for date in date_range_list:
-            batch_dict = {}
-            batch_dict['start_date'] = date.strftime("%Y-%m-%d")
-            batch_dict['end_date'] = date.strftime("%Y-%m-%d")
-            batch_date_list.append(batch_dict)
-    elif batch_freq == "weekly":
-        # Check if start date is the first day (Sunday) of a week. If not, then force to the first day of the week
-        if start_date_dt.isoweekday() != 7:
-            new_start_date = (start_date_dt - timedelta(days=((start_date_dt.isoweekday()) % 7))).strftime("%Y-%m-%d")
-        else:
-            new_start_date = start_date
-        # Check if end date is the last day (Saturday) of a week. If not, then force to the last day of the week
-        if end_date_dt.isoweekday() != 6:
-            new_end_date = (end_date_dt + timedelta(days=((13 - end_date_dt.isoweekday()) % 7))).strftime("%Y-%m-%d")
-        else:
-            new_end_date = end_date
-
-        date_range_list = pd.date_range(new_start_date, new_end_date, freq="W").tolist()
-        for date in date_range_list:
-            batch_dict = {}
-            batch_dict['start_date'] = date.strftime("%Y-%m-%d")
-            batch_end_date_dt = (date + timedelta(days=((13 - date.isoweekday()) % 7)))
-            batch_dict['end_date'] = batch_end_date_dt.strftime("%Y-%m-%d")
-            batch_date_list.append(batch_dict)
-    elif batch_freq == "monthly":
-        # Check if start date is the first day of a month. If not, then force to the first day of the month
-        if start_date_dt.day != 1:
-            new_start_date = start_date_dt.replace(day=1).strftime("%Y-%m-%d")
-        else:
-            new_start_date = start_date
-        # Check if start date is the last day of a month. If not, then force to the last day of the month
-        end_date_month_last_day_dt = datetime(end_date_dt.year, end_date_dt.month, calendar.monthrange(end_date_dt.year, end_date_dt.month)[1])
-        if end_date_dt != end_date_month_last_day_dt:
-            new_end_date = end_date_month_last_day_dt.strftime("%Y-%m-%d")
-        else:
-            new_end_date = end_date
-
-        date_range_list = pd.date_range(new_start_date, new_end_date, freq="MS").tolist()
-        for date in date_range_list:
-            batch_dict = {}
-            batch_dict['start_date'] = date.strftime("%Y-%m-%d")
-            batch_end_date_dt = datetime(date.year, date.month, calendar.monthrange(date.year, date.month)[1])
-            batch_dict['end_date'] = batch_end_date_dt.strftime("%Y-%m-%d")
-            batch_date_list.append(batch_dict)
+        return [(datetime.strptime(start_date, "%Y-%m-%d").strftime("%Y-%m-%d"), datetime.strptime(end_date, "%Y-%m-%d").strftime("%Y-%m-%d"))]
+    if batch_freq not in BATCH_FREQ_PERIODS:
+        return []
 
-    return batch_date_list
+    periods = pd.period_range(start_date, end_date, freq=BATCH_FREQ_PERIODS[batch_freq])
+    return list(zip(periods.start_time.strftime("%Y-%m-%d"), periods.end_time.strftime("%Y-%m-%d")))
 
-def download_blob(bucket_name, source_blob_name, destination_file_name, project_id = None):
-    """Download a file from a Google Cloud Storage bucket to a local file location
+def download_blobs(bucket_name, source_destination_pairs, project_id = None):
+    """Download multiple files from a Google Cloud Storage bucket to local file locations in parallel
 
     Args:
         bucket_name (string): Name of the source Google Cloud Storage bucket
-        source_blob_name (string): Name of the source Google Cloud Storage bucket path location
-        destination_file_name (string): Local destination path location to write the file
+        source_destination_pairs (list): A list of (source blob name, local destination path) tuples
         project_id (string, optional): Google Cloud Platform project id where the source storage bucket exists. Defaults to None and looks for the project id in an environment variable 'GCP_PROJECT'.
 
     Raises:
         Exception: If the source storage bucket does not exist, then raise this exception.
     """
 
-    if project_id is None:
-        storage_client = storage.Client(project=os.environ.get('GCP_PROJECT'))
-    else:
-        storage_client = storage.Client(project=project_id)
+    storage_client = _client(project_id)
 
     try:
         bucket = storage_client.get_bucket(bucket_name)
     except Exception as exc:
         raise Exception("Destination bucket with config file does not exist") from exc
 
-    blob = bucket.blob(source_blob_name)
+    blob_file_pairs = [(bucket.blob(source_blob_name), destination_file_name) for source_blob_name, destination_file_name in source_destination_pairs]
+
+    transfer_manager.download_many(blob_file_pairs, max_workers=len(blob_file_pairs), worker_type=transfer_manager.THREAD, raise_exception=True)
 
-    blob.download_to_filename(destination_file_name)
+    for source_blob_name, destination_file_name in source_destination_pairs:
+        print(f"Blob {source_blob_name} downloaded to {destination_file_name}")
 
-    print(f"Blob {source_blob_name} downloaded to {destination_file_name}")
+def _client(project_id = None):
+    """Return a cached Google Cloud Storage client, creating one on first use
+
+    Args:
+        project_id (string, optional): Google Cloud Platform project id for the client. Defaults to None and looks for the project id in an environment variable 'GCP_PROJECT'.
+
+    Returns:
+        google.cloud.storage.Client: A storage client for the project and current GOOGLE_APPLICATION_CREDENTIALS
+    """
+    # Each request can download a different service account to the same credentials file, so key on its contents rather than its path
+    credentials_file = os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')
+    credentials_digest = None
+    if credentials_file is not None and os.path.isfile(credentials_file):
+        with open(credentials_file, 'rb') as credentials:
+            credentials_digest = hashlib.sha256(credentials.read()).hexdigest()
+    key = (project_id or os.environ.get('GCP_PROJECT'), credentials_file, credentials_digest)
+    storage_client = _CLIENT_CACHE.get(key)
+    if storage_client is None:
+        storage_client = storage.Client(project=key[0])
+        _CLIENT_CACHE[key] = storage_client
+    return storage_client
@@ -0,0 +1,40 @@
+from main import ga_api_split_request_date_batch_freq
+
+def test_split_request_date_batch_freq_none_returns_full_range():
+    assert ga_api_split_request_date_batch_freq('2023-01-04', '2023-02-15') == [('2023-01-04', '2023-02-15')]
+
+def test_split_request_date_batch_freq_daily():
+    assert ga_api_split_request_date_batch_freq('2023-01-30', '2023-02-02', 'daily') == [
+        ('2023-01-30', '2023-01-30'),
+        ('2023-01-31', '2023-01-31'),
+        ('2023-02-01', '2023-02-01'),
+        ('2023-02-02', '2023-02-02'),
+    ]
+
+def test_split_request_date_batch_freq_weekly_expands_to_whole_weeks():
+    # 2023-01-04 and 2023-01-18 are Wednesdays; weeks run Sunday to Saturday
+    assert ga_api_split_request_date_batch_freq('2023-01-04', '2023-01-18', 'weekly') == [
+        ('2023-01-01', '2023-01-07'),
+        ('2023-01-08', '2023-01-14'),
+        ('2023-01-15', '2023-01-21'),
+    ]
+
+def test_split_request_date_batch_freq_weekly_across_year_end():
+    assert ga_api_split_request_date_batch_freq('2022-12-30', '2023-01-02', 'weekly') == [
+        ('2022-12-25', '2022-12-31'),
+        ('2023-01-01', '2023-01-07'),
+    ]
+
+def test_split_request_date_batch_freq_monthly_expands_to_whole_months():
+    assert ga_api_split_request_date_batch_freq('2024-01-15', '2024-03-10', 'monthly') == [
+        ('2024-01-01', '2024-01-31'),
+        ('2024-02-01', '2024-02-29'),
+        ('2024-03-01', '2024-03-31'),
+    ]
+
+def test_split_request_date_batch_freq_start_after_end_returns_no_batches():
+    for batch_freq in ('daily', 'weekly', 'monthly'):
+        assert ga_api_split_request_date_batch_freq('2023-03-10', '2023-01-15', batch_freq) == []
+
+def test_split_request_date_batch_freq_unknown_frequency_returns_no_batches():
+    assert ga_api_split_request_date_batch_freq('2023-01-01', '2023-01-31', 'yearly') == []